@@ -1,17 +1,27 @@
-from flask import Flask, request, send_file, jsonify, render_template
+from flask import Flask, request, send_file, render_template
 from flask_cors import CORS
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
+import PIL
+import cv2
+import numpy as np
 import io
-import json
+import logging
+import orjson
 import os
 from core.dct import embed_dct, extract_dct, DCTError
 
 # 引入我們分離出去的核心邏輯
-from core.stego import encode_image, decode_image, StegoError
+from core.stego import encode_image, decode_image, load_rgb_pixels, extract_bit_planes, decode_bit_planes, StegoError
 
 app = Flask(__name__)
 CORS(app)
 
+# 確認實際載入的是不是 Pillow-SIMD (版本號會帶 .postN 後綴，例如 10.0.1.post0)
+# (Flask logger 沒開 debug 時預設只輸出 WARNING 以上，要明確調成 INFO 這行才會出現在 gunicorn 的 log)
+PIL_SIMD = 'post' in PIL.__version__
+app.logger.setLevel(logging.INFO)
+app.logger.info(f"Pillow {PIL.__version__} ({'SIMD 加速' if PIL_SIMD else '標準版'})")
+
 # 設定最大上傳限制 (例如 16MB)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 
@@ -20,6 +30,66 @@ def index():
     # Flask 標準做法是將 HTML 放在 templates 資料夾
     return render_template('index.html')
 
+def upload_buffer(file):
+    """
+    取得上傳檔案的內容，盡量不複製
+    Werkzeug 的 file.stream 是 SpooledTemporaryFile：小檔案還留在記憶體時底下是 BytesIO，
+    可以直接拿 getbuffer() 的 memoryview；已經寫到暫存檔的大檔案才退回 read()
+    """
+    inner = getattr(file.stream, '_file', file.stream)
+    if isinstance(inner, io.BytesIO):
+        return inner.getbuffer()
+    return file.read()
+
+# JPEG 可以讓 libjpeg 直接用縮小的解析度解碼 (等同 Pillow 的 draft)
+# (IMREAD_REDUCED_GRAYSCALE_N 只有縮小比例的旗標，和 IMREAD_ANYCOLOR 組合就會保留原本的彩色/灰階)
+REDUCED_DECODE_FLAGS = [
+    (8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+    (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    (2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+]
+
+# DCT 路由解碼前的畫素上限 (沿用 Pillow 的解壓縮炸彈警告門檻，約 8900 萬畫素)
+DCT_MAX_PIXELS = Image.MAX_IMAGE_PIXELS
+
+def json_response(data, status=200):
+    """用 orjson 序列化 JSON 回應 (比 jsonify 的標準 json 快)"""
+    return app.response_class(orjson.dumps(data), status=status, mimetype='application/json')
+
+def read_cv2_image(file, max_dim=None):
+    """
+    DCT 路由專用：直接用 OpenCV 從上傳的 buffer 解碼成 BGR (灰階圖維持 2 維)，不經過 Pillow
+    解碼前先用 Pillow 讀檔頭檢查畫素數，超過 DCT_MAX_PIXELS 直接拒絕
+    有給 max_dim 時，大張 JPEG 會挑一個縮小後仍不小於 max_dim 的比例來解碼
+    """
+    raw = upload_buffer(file)
+    data = np.frombuffer(raw, dtype=np.uint8)
+    flags = cv2.IMREAD_ANYCOLOR
+    
+    # Pillow 只讀檔頭拿尺寸，不會真的解碼
+    # (OpenCV 最多會接受 2^30 畫素，小小的 PNG 就能讓它吃掉好幾 GB 記憶體)
+    file.stream.seek(0)
+    try:
+        width, height = Image.open(file.stream).size
+    except (UnidentifiedImageError, OSError):
+        raise DCTError("無法讀取圖片，請確認檔案格式")
+    except Image.DecompressionBombError:
+        raise DCTError("圖片畫素過多，無法處理")
+    if width * height > DCT_MAX_PIXELS:
+        raise DCTError("圖片畫素過多，無法處理")
+    
+    if max_dim and bytes(raw[:2]) == b'\xff\xd8':
+        longest = max(width, height)
+        for factor, reduced in REDUCED_DECODE_FLAGS:
+            if longest // factor >= max_dim:
+                flags = cv2.IMREAD_ANYCOLOR | reduced
+                break
+    
+    img = cv2.imdecode(data, flags)
+    if img is None:
+        raise DCTError("無法讀取圖片，請確認檔案格式")
+    return img
+
 @app.route('/encode', methods=['POST'])
 def handle_encode():
     try:
@@ -28,9 +98,9 @@ def handle_encode():
         bit_map_str = request.form.get('bit_map') 
         
         if not file or not message or not bit_map_str:
-            return jsonify({"error": "缺少必要資料"}), 400
+            return json_response({"error": "缺少必要資料"}, 400)
         
-        bit_map = json.loads(bit_map_str)
+        bit_map = orjson.loads(bit_map_str)
         bit_map.sort(key=lambda x: (x['b'], x['c']))
         
         img = Image.open(file.stream)
@@ -39,7 +109,8 @@ def handle_encode():
         secret_img = encode_image(img, message, bit_map)
         
         output_buffer = io.BytesIO()
-        secret_img.save(output_buffer, format="PNG")
+        # LSB 一定要無損的 PNG；壓縮等級 1 編碼快很多，檔案只大一點點
+        secret_img.save(output_buffer, format="PNG", compress_level=1)
         output_buffer.seek(0)
         
         return send_file(
@@ -50,9 +121,9 @@ def handle_encode():
         )
 
     except StegoError as e:
-        return jsonify({"error": str(e)}), 400
+        return json_response({"error": str(e)}, 400)
     except Exception as e:
-        return jsonify({"error": "伺服器內部錯誤"}), 500
+        return json_response({"error": "伺服器內部錯誤"}, 500)
 
 @app.route('/decode', methods=['POST'])
 def handle_decode():
@@ -61,55 +132,64 @@ def handle_decode():
         bit_map_str = request.form.get('bit_map')
         
         if not file or not bit_map_str:
-            return jsonify({"error": "資料不完整"}), 400
+            return json_response({"error": "資料不完整"}, 400)
 
-        img = Image.open(file.stream)
-        bit_map = json.loads(bit_map_str)
+        pixels = load_rgb_pixels(file.read())
+        bit_map = orjson.loads(bit_map_str)
         bit_map.sort(key=lambda x: (x['b'], x['c']))
         
-        msg = decode_image(img, bit_map)
+        msg = decode_image(pixels, bit_map)
         
         if msg:
-            return jsonify({"message": msg})
+            return json_response({"message": msg})
         else:
-            return jsonify({"message": "解密失敗：密碼錯誤或無訊息"})
+            return json_response({"message": "解密失敗：密碼錯誤或無訊息"})
 
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return json_response({"error": str(e)}, 500)
+
+# 自動破解的常見策略：每個請求都一樣，啟動時排序好一次就好
+AUTO_DECODE_SUSPECTS = tuple(
+    (name, sorted(bit_map, key=lambda x: (x['b'], x['c'])))
+    for name, bit_map in [
+        ("標準 LSB (RGB Bit 0)", [{'c':0,'b':0}, {'c':1,'b':0}, {'c':2,'b':0}]),
+        ("僅紅色 R0", [{'c':0,'b':0}]),
+        ("僅綠色 G0", [{'c':1,'b':0}]),
+        ("僅藍色 B0", [{'c':2,'b':0}]),
+        ("無紅模式 (G0, B0)", [{'c':1,'b':0}, {'c':2,'b':0}])
+    ]
+)
+AUTO_DECODE_POSITIONS = frozenset(
+    (t['c'], t['b']) for _, bit_map in AUTO_DECODE_SUSPECTS for t in bit_map
+)
 
 @app.route('/auto_decode', methods=['POST'])
 def handle_auto_decode():
     try:
         file = request.files.get('image')
-        if not file: return jsonify({"error": "未上傳圖片"}), 400
+        if not file: return json_response({"error": "未上傳圖片"}, 400)
         
-        img = Image.open(file.stream)
+        pixels = load_rgb_pixels(file.read())
+        
+        # 所有策略用到的 bit plane (R0, G0, B0) 先一次取出，之後每個策略只負責重新排列
+        planes = extract_bit_planes(pixels, AUTO_DECODE_POSITIONS)
         
-        # 定義常見策略
-        suspects = [
-            ("標準 LSB (RGB Bit 0)", [{'c':0,'b':0}, {'c':1,'b':0}, {'c':2,'b':0}]),
-            ("僅紅色 R0", [{'c':0,'b':0}]),
-            ("僅綠色 G0", [{'c':1,'b':0}]),
-            ("僅藍色 B0", [{'c':2,'b':0}]),
-            ("無紅模式 (G0, B0)", [{'c':1,'b':0}, {'c':2,'b':0}])
-        ]
-        
-        # 執行暴力破解
-        for name, bit_map in suspects:
-            bit_map.sort(key=lambda x: (x['b'], x['c']))
-            msg = decode_image(img, bit_map)
+        # 執行暴力破解：依序嘗試，找到就停 (最常見的標準 LSB 排第一個)
+        # plane 已經共用，每個策略只剩打包和找結束符號，放到執行緒池反而浪費 CPU
+        for name, bit_map in AUTO_DECODE_SUSPECTS:
+            msg = decode_bit_planes(planes, bit_map)
             if msg:
-                return jsonify({
+                return json_response({
                     "success": True,
                     "strategy": name,
                     "message": msg,
                     "found_map": bit_map
                 })
         
-        return jsonify({"success": False, "message": "自動破解失敗"})
+        return json_response({"success": False, "message": "自動破解失敗"})
 
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return json_response({"error": str(e)}, 500)
     
 # ==========================================
 #  DCT 浮水印路由
@@ -122,51 +202,51 @@ def handle_dct_encode():
         message = request.form.get('message')
         
         if not file or not message:
-            return jsonify({"error": "缺少必要資料"}), 400
+            return json_response({"error": "缺少必要資料"}, 400)
         
-        img = Image.open(file.stream)
+        img = read_cv2_image(file, max_dim=1000)
         # DCT 不需要 bit_map，但同樣需要縮圖防爆，避免運算過久
         # 注意：DCT 演算法需要 8 的倍數，簡單縮圖即可
-        if img.width > 1000 or img.height > 1000:
-             img.thumbnail((1000, 1000))
-        
-        # 確保是 RGB
-        img = img.convert("RGB")
+        h, w = img.shape[:2]
+        if w > 1000 or h > 1000:
+             scale = 1000 / max(w, h)
+             size = (max(1, round(w * scale)), max(1, round(h * scale)))
+             img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
         
         # 呼叫 DCT 核心
         watermarked_img = embed_dct(img, message)
         
-        output_buffer = io.BytesIO()
         # 這裡一定要存成 JPEG 來證明它抗壓縮！(原本 PNG 是無損的，DCT 強項是 JPG)
         # 但為了方便 demo，我們先存 PNG，可以請使用者自己轉 JPG 測試
-        watermarked_img.save(output_buffer, format="PNG")
-        output_buffer.seek(0)
+        ok, buf = cv2.imencode('.png', watermarked_img, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        if not ok:
+            raise DCTError("圖片輸出失敗")
         
         return send_file(
-            output_buffer, 
+            io.BytesIO(buf.tobytes()), 
             mimetype='image/png', 
             as_attachment=True, 
             download_name='dct_watermark.png'
         )
 
     except DCTError as e:
-        return jsonify({"error": str(e)}), 400
+        return json_response({"error": str(e)}, 400)
     except Exception as e:
-        return jsonify({"error": "DCT 處理錯誤: " + str(e)}), 500
+        return json_response({"error": "DCT 處理錯誤: " + str(e)}, 500)
 
 @app.route('/dct_decode', methods=['POST'])
 def handle_dct_decode():
     try:
         file = request.files.get('image')
-        if not file: return jsonify({"error": "未上傳圖片"}), 400
+        if not file: return json_response({"error": "未上傳圖片"}, 400)
 
-        img = Image.open(file.stream).convert("RGB")
+        img = read_cv2_image(file)
         msg = extract_dct(img)
         
-        return jsonify({"message": msg})
+        return json_response({"message": msg})
 
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return json_response({"error": str(e)}, 500)
 
 if __name__ == '__main__':
     # 讓 Gunicorn 可以在生產環境找到 app，開發環境用 debug
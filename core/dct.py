@@ -1,28 +1,52 @@
 import cv2
 import numpy as np
-from PIL import Image
+from scipy import fft
+
+try:
+    # numba 可以把 8x8 區塊迴圈編譯成機器碼並分散到多核心；沒裝就退回 SciPy 整批轉換
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
 
 class DCTError(Exception):
     pass
 
+# 修改係數關係來編碼 (差距 K=50，越大越抗壓縮但畫質越差)
+DCT_K = 50
+
+def _dct_basis(n=8):
+    """8x8 DCT-II 正交基底矩陣 U，cv2.dct(block) == U @ block @ U.T"""
+    x = np.arange(n)
+    u = x.reshape(-1, 1)
+    basis = np.cos((2 * x + 1) * u * np.pi / (2 * n)) * np.sqrt(2 / n)
+    basis[0] /= np.sqrt(2)
+    return basis
+
+# numba 路徑用定點數 (fixed-point) 計算：係數 (u, v) = sum(block * outer(U[u], U[v]))
+# 只需要 P1 (4, 1) 和 P2 (3, 2) 兩個係數，把它們的基底圖放大 2^14 存成 int16
+# (最大值約 3940)，乘上 0-255 的像素累加 64 次也不會超出 int32
+DCT_FRAC_BITS = 14
+
+def _coef_weight(u, v):
+    basis = _dct_basis()
+    return np.round(np.outer(basis[u], basis[v]) * (1 << DCT_FRAC_BITS)).astype(np.int16)
+
+DCT_W_P1 = _coef_weight(4, 1)
+DCT_W_P2 = _coef_weight(3, 2)
+
 def str_to_bin(message):
-    """將文字轉為二進位 (UTF-8)"""
-    return ''.join(format(b, '08b') for b in message.encode('utf-8'))
+    """將文字轉為二進位 (UTF-8)，回傳 0/1 組成的 uint8 陣列 (MSB 在前)"""
+    return np.unpackbits(np.frombuffer(message.encode('utf-8'), dtype=np.uint8))
 
 def bin_to_str(binary_data):
     """
-    修正版：將二進位字串轉回 UTF-8 文字
-    支援中文的關鍵：先收集成 bytearray，再一次性 decode
+    修正版：將 0/1 bit 陣列轉回 UTF-8 文字
+    支援中文的關鍵：先用 packbits 收集成 bytes，再一次性 decode
     """
-    byte_data = bytearray()
-    
-    for i in range(0, len(binary_data), 8):
-        chunk = binary_data[i:i+8]
-        # 如果最後不滿 8 bit 就丟掉 (避免錯誤)
-        if len(chunk) < 8: break
-        
-        byte_val = int(chunk, 2)
-        byte_data.append(byte_val)
+    # 如果最後不滿 8 bit 就丟掉 (避免錯誤)
+    usable = len(binary_data) // 8 * 8
+    byte_data = np.packbits(binary_data[:usable]).tobytes()
     
     try:
         # errors='replace' 是浮水印的關鍵！
@@ -32,36 +56,136 @@ def bin_to_str(binary_data):
     except Exception:
         return ""
 
-def extract_dct(img_pil: Image.Image) -> str:
-    """讀取 DCT 浮水印 (修正版)"""
-    img_np = np.array(img_pil)
+if HAS_NUMBA:
+    @njit(cache=True)
+    def _coef(block, weight):
+        """定點數計算單一 DCT 係數 (int16 x int16 累加，最後四捨五入移回整數)"""
+        acc = np.int32(0)
+        for i in range(8):
+            for j in range(8):
+                acc += np.int32(block[i, j]) * np.int32(weight[i, j])
+        return (acc + (1 << (DCT_FRAC_BITS - 1))) >> DCT_FRAC_BITS
+
+    @njit(parallel=True, cache=True)
+    def _embed_kernel(y_channel, bits, k, w1, w2):
+        """
+        依序在每個 8x8 區塊藏 1 bit，區塊列之間平行處理 (直接修改 int16 的 y_channel)
+        DCT 是線性的：只改 P1 / P2 時，IDCT 的結果 = 原區塊 + 變化量 x 該係數的基底圖
+        所以不用做完整的正反變換，其餘 62 個係數也完全不受影響
+        """
+        nbx = y_channel.shape[1] // 8
+        msg_len = bits.shape[0]
+        rows = (msg_len + nbx - 1) // nbx
+        half = 1 << (DCT_FRAC_BITS - 1)
+        for br in prange(rows):
+            for bc in range(nbx):
+                i = br * nbx + bc
+                if i >= msg_len:
+                    break
+                
+                block = y_channel[br*8:br*8+8, bc*8:bc*8+8]
+                p1 = _coef(block, w1)
+                p2 = _coef(block, w2)
+                
+                d1 = 0
+                d2 = 0
+                if bits[i] == 0:
+                    if p1 <= p2 + k:
+                        d1 = p2 + k + 1 - p1
+                else:
+                    if p2 <= p1 + k:
+                        d2 = p1 + k + 1 - p2
+                
+                if d1 != 0 or d2 != 0:
+                    for r in range(8):
+                        for c in range(8):
+                            delta = d1 * np.int32(w1[r, c]) + d2 * np.int32(w2[r, c])
+                            block[r, c] += (delta + half) >> DCT_FRAC_BITS
+
+    @njit(parallel=True, cache=True)
+    def _extract_kernel(y_channel, w1, w2):
+        """每個 8x8 區塊讀出 1 bit：P1 <= P2 為 1，否則為 0"""
+        nby = y_channel.shape[0] // 8
+        nbx = y_channel.shape[1] // 8
+        bits = np.zeros(nby * nbx, dtype=np.uint8)
+        for br in prange(nby):
+            for bc in range(nbx):
+                block = y_channel[br*8:br*8+8, bc*8:bc*8+8]
+                if _coef(block, w1) <= _coef(block, w2):
+                    bits[br * nbx + bc] = 1
+        return bits
+
+def _crop8(y_channel):
+    """裁成長寬都是 8 的倍數 (最右、最下不滿 8x8 的邊不會用到)"""
+    h, w = y_channel.shape
+    return y_channel[:h // 8 * 8, :w // 8 * 8]
+
+def _to_blocks(y_channel):
+    """
+    把 Y 通道切成連續記憶體的 (區塊數, 8, 8)，依列優先排列 (和逐塊掃描的順序相同)
+    每個 8x8 區塊的 64 個值排在一起，之後整批轉換時不會再有跨列的 stride 存取
+    """
+    y8 = _crop8(y_channel)
+    nby, nbx = y8.shape[0] // 8, y8.shape[1] // 8
+    return y8.reshape(nby, 8, nbx, 8).transpose(0, 2, 1, 3).reshape(-1, 8, 8)
+
+def _from_blocks(blocks, nbx):
+    """_to_blocks 的反向：(區塊數, 8, 8) 排回 2 維影像"""
+    nby = len(blocks) // nbx
+    return blocks.reshape(nby, nbx, 8, 8).transpose(0, 2, 1, 3).reshape(nby * 8, nbx * 8)
+
+def _embed_blocks_scipy(y_channel, binary_data, k):
+    """沒有 numba 時的備案：所有需要的區塊一次丟給 scipy.fft.dctn / idctn"""
+    nbx = y_channel.shape[1] // 8
+    msg_len = len(binary_data)
     
-    # 轉 YCrCb (確保相容灰階與 RGB)
-    if len(img_np.shape) == 2: 
-         img_cv = cv2.cvtColor(img_np, cv2.COLOR_GRAY2BGR)
-         img_cv = cv2.cvtColor(img_cv, cv2.COLOR_BGR2YCrCb)
+    # 只切出訊息會用到的那幾列區塊
+    rows = -(-msg_len // nbx)
+    region = _crop8(y_channel)[:rows * 8]
+    blocks = _to_blocks(region)
+    dct_blocks = fft.dctn(blocks[:msg_len], type=2, axes=(-2, -1), norm='ortho', workers=-1)
+    
+    # 選定兩個中頻位置 (P1, P2) 來比較
+    # 這裡選 (4, 1) 和 (3, 2) 是經驗法則，抗壓縮能力不錯
+    p1 = dct_blocks[:, 4, 1].copy()
+    p2 = dct_blocks[:, 3, 2].copy()
+    bit0 = binary_data == 0
+    
+    # 若要藏 0，確保 P1 > P2 + k；若要藏 1，確保 P2 > P1 + k
+    dct_blocks[:, 4, 1] = np.where(bit0 & (p1 <= p2 + k), p2 + k + 1, p1)
+    dct_blocks[:, 3, 2] = np.where(~bit0 & (p2 <= p1 + k), p1 + k + 1, p2)
+    
+    # IDCT 反變換後只寫回有藏資料的區塊
+    blocks[:msg_len] = fft.idctn(dct_blocks, type=2, axes=(-2, -1), norm='ortho', workers=-1)
+    region[:] = _from_blocks(blocks, nbx)
+
+def _extract_blocks_scipy(y_channel):
+    """沒有 numba 時的備案：一次對所有區塊做 dctn 後比較 P1 / P2"""
+    blocks = _to_blocks(y_channel)
+    if len(blocks) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    
+    dct_blocks = fft.dctn(blocks, type=2, axes=(-2, -1), norm='ortho', workers=-1)
+    return (dct_blocks[:, 4, 1] <= dct_blocks[:, 3, 2]).astype(np.uint8)
+
+def extract_dct(img_bgr: np.ndarray) -> str:
+    """讀取 DCT 浮水印 (修正版)，輸入為 OpenCV 的 BGR (或灰階) 陣列"""
+    # 灰階圖的亮度就是圖片本身，不用轉 YCrCb；彩色圖才需要轉換取出 Y 通道
+    if img_bgr.ndim == 2:
+         y_plane = img_bgr
     else:
-         img_cv = cv2.cvtColor(img_np, cv2.COLOR_RGB2YCrCb)
+         y_plane = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2YCrCb)[:, :, 0]
          
-    h, w, _ = img_cv.shape
-    y_channel = img_cv[:, :, 0].astype(np.float32)
-    
-    extracted_bits = ""
+    # 先裁成 8 的倍數並整理成連續記憶體 (cvtColor 取出的 Y 通道每個像素間隔 3 bytes)
+    y_plane = np.ascontiguousarray(_crop8(y_plane))
     delimiter = "#####"
     
-    # 遍歷區塊讀取
-    for row in range(0, h - 7, 8):
-        for col in range(0, w - 7, 8):
-            block = y_channel[row:row+8, col:col+8]
-            dct_block = cv2.dct(block)
-            
-            p1 = dct_block[4, 1]
-            p2 = dct_block[3, 2]
-            
-            if p1 > p2:
-                extracted_bits += "0"
-            else:
-                extracted_bits += "1"
+    # 遍歷區塊讀取，每個 8x8 區塊讀出 1 bit
+    # numba 的定點數路徑可以直接讀 uint8 的 Y 通道，SciPy 路徑則用 float32
+    if HAS_NUMBA:
+        extracted_bits = _extract_kernel(y_plane, DCT_W_P1, DCT_W_P2)
+    else:
+        extracted_bits = _extract_blocks_scipy(y_plane.astype(np.float32))
     
     # 嘗試解碼
     full_text = bin_to_str(extracted_bits)
@@ -73,17 +197,22 @@ def extract_dct(img_pil: Image.Image) -> str:
     # 我們只回傳前 20 個字，避免畫面被大量亂碼塞滿
     return f"未找到完整結束符號 (可能圖片被裁切)，嘗試解讀部分內容：{full_text[:20]}..."
 
-def embed_dct(img_pil: Image.Image, message: str) -> Image.Image:
+def embed_dct(img_bgr: np.ndarray, message: str) -> np.ndarray:
     """
     使用 DCT 變換將訊息寫入圖片 (抗壓縮浮水印)
     原理：修改 Y 通道 (亮度) 的 8x8 區塊中頻係數
+    輸入輸出皆為 OpenCV 的 BGR 陣列，方便直接 imdecode / imencode
+    灰階圖 (2 維陣列) 只處理亮度本身，輸出也維持灰階
     """
-    # 1. 前置處理：轉為 numpy 格式並轉成 YCrCb 顏色空間
-    # OpenCV 使用 BGR，Pillow 使用 RGB，需轉換
-    img_np = np.array(img_pil)
-    img_cv = cv2.cvtColor(img_np, cv2.COLOR_RGB2YCrCb)
+    # 1. 前置處理：BGR 直接轉成 YCrCb 顏色空間 (灰階圖的亮度就是圖片本身，跳過轉換)
+    is_gray = img_bgr.ndim == 2
+    if is_gray:
+        y_plane = img_bgr
+    else:
+        img_cv = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2YCrCb)
+        y_plane = img_cv[:, :, 0]
     
-    h, w, _ = img_cv.shape
+    h, w = y_plane.shape
     
     # 2. 容量檢查
     # 每個 8x8 區塊只能藏 1 bit
@@ -95,102 +224,25 @@ def embed_dct(img_pil: Image.Image, message: str) -> Image.Image:
         raise DCTError(f"訊息太長！DCT 模式容量較小。圖片可藏 {max_bits} bits，但你需要 {len(binary_data)} bits。")
 
     # 取出 Y 通道 (亮度)，因為人眼對亮度變化較不敏感，適合藏浮水印
-    y_channel = img_cv[:, :, 0].astype(np.float32)
-
-    data_index = 0
-    msg_len = len(binary_data)
-
-    # 3. 遍歷所有 8x8 區塊
-    for row in range(0, h - 7, 8):
-        for col in range(0, w - 7, 8):
-            if data_index >= msg_len:
-                break
-            
-            # 取得 8x8 區塊
-            block = y_channel[row:row+8, col:col+8]
-            
-            # 進行 DCT 變換 (轉成頻率域)
-            dct_block = cv2.dct(block)
-            
-            # 選定兩個中頻位置 (P1, P2) 來比較
-            # 這裡選 (4, 1) 和 (3, 2) 是經驗法則，抗壓縮能力不錯
-            p1 = dct_block[4, 1]
-            p2 = dct_block[3, 2]
-            
-            bit = int(binary_data[data_index])
-            
-            # 修改係數關係來編碼 (差距 K=50，越大越抗壓縮但畫質越差)
-            k = 50
-            
-            if bit == 0:
-                # 若要藏 0，確保 P1 > P2 + k
-                if p1 <= p2 + k:
-                    p1 = p2 + k + 1
-            else:
-                # 若要藏 1，確保 P2 > P1 + k
-                if p2 <= p1 + k:
-                    p2 = p1 + k + 1
-            
-            dct_block[4, 1] = p1
-            dct_block[3, 2] = p2
-            
-            # 進行 IDCT 反變換 (轉回圖片)
-            y_channel[row:row+8, col:col+8] = cv2.idct(dct_block)
-            
-            data_index += 1
-
-    # 4. 組合回去
-    # 確保數值在 0-255 之間
-    y_channel = np.clip(y_channel, 0, 255).astype(np.uint8)
-    img_cv[:, :, 0] = y_channel
+    # 訊息只會用到前面幾列區塊，只把那幾列複製出來運算
+    rows = -(-len(binary_data) // (w // 8)) * 8
     
-    # 轉回 RGB 並變回 Pillow 物件
-    img_rgb = cv2.cvtColor(img_cv, cv2.COLOR_YCrCb2RGB)
-    return Image.fromarray(img_rgb)
-
-
-    """讀取 DCT 浮水印"""
-    img_np = np.array(img_pil)
-    
-    # 轉 YCrCb
-    if len(img_np.shape) == 2: # 如果是灰階
-         img_cv = cv2.cvtColor(img_np, cv2.COLOR_GRAY2BGR) # 先假轉
-         img_cv = cv2.cvtColor(img_cv, cv2.COLOR_BGR2YCrCb)
+    # 3. 遍歷所有 8x8 區塊 (numba 用 int16 定點數，SciPy 備案維持 float32)
+    if HAS_NUMBA:
+        y_channel = y_plane[:rows].astype(np.int16)
+        _embed_kernel(y_channel, binary_data, DCT_K, DCT_W_P1, DCT_W_P2)
     else:
-         img_cv = cv2.cvtColor(img_np, cv2.COLOR_RGB2YCrCb)
-         
-    h, w, _ = img_cv.shape
-    y_channel = img_cv[:, :, 0].astype(np.float32)
-    
-    extracted_bits = ""
-    delimiter = "#####"
-    
-    # 遍歷區塊讀取
-    for row in range(0, h - 7, 8):
-        for col in range(0, w - 7, 8):
-            block = y_channel[row:row+8, col:col+8]
-            dct_block = cv2.dct(block)
-            
-            p1 = dct_block[4, 1]
-            p2 = dct_block[3, 2]
-            
-            # 判斷 bit
-            if p1 > p2:
-                extracted_bits += "0"
-            else:
-                extracted_bits += "1"
-    
-    # 將 bit 轉回文字，並尋找結束符號
-    # 這裡不做嚴格的 8 bit 切割，因為 DCT 經過壓縮可能會有一兩個 bit 讀錯
-    # 我們嘗試還原出文字
-    
-    full_text = ""
-    try:
-        full_text = bin_to_str(extracted_bits)
-    except:
-        pass
-        
-    if delimiter in full_text:
-        return full_text.split(delimiter)[0]
-    
-    return "解讀失敗或無浮水印 (DCT 模式雜訊較多，請確保圖片清晰)"
\ No newline at end of file
+        y_channel = y_plane[:rows].astype(np.float32)
+        _embed_blocks_scipy(y_channel, binary_data, DCT_K)
+
+    # 4. 組合回去
+    # 確保數值在 0-255 之間：原地 clip，寫回 uint8 時順便轉型，不另外配置暫存陣列
+    np.clip(y_channel, 0, 255, out=y_channel)
+    if is_gray:
+        result = img_bgr.copy()
+        result[:rows] = y_channel
+        return result
+    img_cv[:rows, :, 0] = y_channel
+    
+    # 轉回 BGR，交給 cv2.imencode 輸出
+    return cv2.cvtColor(img_cv, cv2.COLOR_YCrCb2BGR)
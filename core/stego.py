@@ -1,13 +1,18 @@
 from PIL import Image
+from collections import OrderedDict
+import numpy as np
+import hashlib
+import threading
+import io
 import json
 
 class StegoError(Exception):
     """自定義隱寫術錯誤"""
     pass
 
-def str_to_bin(message: str) -> str:
-    """將文字轉為二進位 (UTF-8)"""
-    return ''.join(format(b, '08b') for b in message.encode('utf-8'))
+def str_to_bin(message: str) -> np.ndarray:
+    """將文字轉為二進位 (UTF-8)，回傳 0/1 組成的 uint8 陣列 (MSB 在前)"""
+    return np.unpackbits(np.frombuffer(message.encode('utf-8'), dtype=np.uint8))
 
 def limit_image_size(img: Image.Image, max_dim=1000) -> Image.Image:
     """
@@ -16,8 +21,11 @@ def limit_image_size(img: Image.Image, max_dim=1000) -> Image.Image:
     這樣可以將記憶體消耗控制在安全範圍 (約 50-100MB)。
     """
     if img.width > max_dim or img.height > max_dim:
+        # JPEG 還沒解碼前先設定 draft，讓 libjpeg 直接用 1/2、1/4、1/8 解析度解碼
+        # (不會產生全尺寸的暫存圖；非 JPEG 格式會直接忽略)
+        img.draft('RGB', (max_dim, max_dim))
         # thumbnail 會進行等比例縮小，直接修改物件本身
-        img.thumbnail((max_dim, max_dim))
+        img.thumbnail((max_dim, max_dim), Image.BICUBIC)
     return img
 
 def encode_image(img: Image.Image, message: str, bit_map: list) -> Image.Image:
@@ -28,6 +36,11 @@ def encode_image(img: Image.Image, message: str, bit_map: list) -> Image.Image:
     img = limit_image_size(img)
     # ===================================
 
+    # 只允許 R/G/B 三個通道的 bit 0-7，避免不合法的 bit_map 寫到奇怪的位置
+    for target in bit_map:
+        if not (0 <= target['c'] <= 2 and 0 <= target['b'] <= 7):
+            raise StegoError("bit_map 格式錯誤：通道需為 0-2、位元需為 0-7")
+
     # 確保是 RGB 模式
     if img.mode != 'RGB':
         img = img.convert("RGB")
@@ -35,81 +48,114 @@ def encode_image(img: Image.Image, message: str, bit_map: list) -> Image.Image:
     full_message = message + "#####"
     binary_data = str_to_bin(full_message)
     
-    pixels = list(img.getdata())
-    capacity = len(pixels) * len(bit_map)
+    # 直接拿整張圖的 (H, W, 3) 像素陣列來改，不再逐像素跑 Python 迴圈
+    # (要寫入所以用 np.array 拿一份可寫的副本，改完 fromarray 直接包回圖片)
+    arr = np.array(img, dtype=np.uint8)
+    flat = arr.reshape(-1, arr.shape[-1])
+    capacity = len(flat) * len(bit_map)
     
     if len(binary_data) > capacity:
         raise StegoError(f"容量不足！圖片縮小後容量為 {capacity} bits，但訊息需要 {len(binary_data)} bits。請減少訊息長度。")
 
-    new_pixels = []
-    data_index = 0
-    msg_len = len(binary_data)
+    # 第 i 個 bit 寫在第 i // n 個像素的第 i % n 個位置 (n = bit_map 長度)
+    # 所以 bit_map 第 j 個位置負責的就是 binary_data[j::n]，整段一次寫入
+    slots = len(bit_map)
     
-    pixel_iter = iter(pixels)
-
-    for p in pixel_iter:
-        pixel = list(p)
+    # 訊息寫完就結束：只處理真的會用到的前幾個像素，其餘 buffer 完全不碰
+    pixels_needed = -(-len(binary_data) // slots)
+    head = flat[:pixels_needed]
+    
+    for j, target in enumerate(bit_map):
+        channel = target['c']
+        bit_pos = target['b']
+        bits = binary_data[j::slots]
+        column = head[:len(bits), channel]
         
-        for target in bit_map:
-            if data_index < msg_len:
-                channel = target['c']
-                bit_pos = target['b']
-                bit_val = int(binary_data[data_index])
-                
-                mask = 1 << bit_pos
-                pixel[channel] = (pixel[channel] & ~mask) | (bit_val << bit_pos)
-                data_index += 1
-            else:
-                break
-        new_pixels.append(tuple(pixel))
-
-    new_img = Image.new(img.mode, img.size)
-    new_img.putdata(new_pixels)
-    return new_img
-
-def decode_image(img: Image.Image, bit_map: list) -> str:
-    """依照 bit_map 解讀圖片訊息"""
+        mask = np.uint8(1 << bit_pos)
+        column &= ~mask
+        column |= bits << bit_pos
+
+    return Image.fromarray(arr)
+
+# 解密用的像素快取：同一張圖重送 (例如反覆按自動破解) 時不用重新解碼
+# 每張最多約 2100000 x 3 bytes，保留 8 張大約 50MB
+PIXEL_CACHE_SIZE = 8
+_pixel_cache = OrderedDict()
+_pixel_cache_lock = threading.Lock()
+
+def check_decode_size(width: int, height: int):
+    """解密前的尺寸檢查，太大的圖直接拒絕"""
     
     # === 🔥 關鍵修改 2：解密前的安全檢查 ===
     # 我們不能幫使用者縮圖 (因為會破壞隱藏的訊息)，但我們可以「拒絕」太大的圖
     # 限制 200萬畫素 (約 1920x1080)，避免伺服器解密時崩潰
-    if img.width * img.height > 2100000:
+    if width * height > 2100000:
         raise StegoError("圖片過大，無法在免費伺服器上解密。請確保圖片是由此工具產生 (長寬小於 1000px)。")
-    # ===================================
+
+def load_rgb_pixels(data: bytes) -> np.ndarray:
+    """
+    把上傳的圖片解碼成唯讀的 (H, W, 3) RGB 陣列
+    以內容的 blake2b 雜湊當 key 做 LRU 快取，重複上傳同一張圖時直接回傳
+    """
+    digest = hashlib.blake2b(data, digest_size=16).digest()
+    with _pixel_cache_lock:
+        pixels = _pixel_cache.get(digest)
+        if pixels is not None:
+            _pixel_cache.move_to_end(digest)
+            return pixels
     
+    # Image.open 只讀檔頭，先檢查尺寸再真的解碼
+    img = Image.open(io.BytesIO(data))
+    check_decode_size(img.width, img.height)
     if img.mode != 'RGB':
         img = img.convert("RGB")
 
-    pixels = list(img.getdata())
-    limit = 800000 
-    count = 0
+    # 解密只需要讀，np.asarray 直接沿用 Pillow 匯出的像素 buffer，不再多複製一份
+    # 快取會被多個請求共用，所以一定要是唯讀
+    pixels = np.asarray(img)
+    pixels.flags.writeable = False
     
-    extracted_bytes = bytearray()
-    current_byte = 0
-    bit_in_byte_count = 0
+    with _pixel_cache_lock:
+        _pixel_cache[digest] = pixels
+        while len(_pixel_cache) > PIXEL_CACHE_SIZE:
+            _pixel_cache.popitem(last=False)
+    return pixels
+
+def extract_bit_planes(pixels: np.ndarray, positions) -> dict:
+    """
+    從 (H, W, 3) 像素陣列一次取出指定的 bit plane，回傳 {(channel, bit): 每個像素的 0/1 陣列}
+    同一張圖要試好幾種 bit_map 時 (例如自動破解)，共用的 plane 只需要算一次
+    """
+    check_decode_size(pixels.shape[1], pixels.shape[0])
+    flat = pixels.reshape(-1, pixels.shape[-1])
+    return {(c, b): (flat[:, c] >> b) & 1 for c, b in positions}
+
+def decode_bit_planes(planes: dict, bit_map: list) -> str:
+    """依照 bit_map 順序把 extract_bit_planes 取出的 plane 交錯排好並解讀訊息"""
+    if not bit_map:
+        return None
+
     delimiter_seq = b'#####'
     
-    for p in pixels:
-        for target in bit_map:
-            channel = target['c']
-            bit_pos = target['b']
-            
-            bit_val = (p[channel] >> bit_pos) & 1
-            current_byte = (current_byte << 1) | bit_val
-            bit_in_byte_count += 1
-            
-            if bit_in_byte_count == 8:
-                extracted_bytes.append(current_byte)
-                current_byte = 0
-                bit_in_byte_count = 0
-                
-                if extracted_bytes.endswith(delimiter_seq):
-                    try:
-                        return extracted_bytes[:-5].decode('utf-8')
-                    except UnicodeDecodeError:
-                        return extracted_bytes[:-5].decode('utf-8', errors='ignore')
-            
-            count += 1
-            if count > limit: return None
-            
-    return None
\ No newline at end of file
+    if len(bit_map) == 1:
+        # 單一 plane (自動破解的 R0 / G0 / B0) 不用交錯，直接拿來打包
+        bits = planes[(bit_map[0]['c'], bit_map[0]['b'])]
+    else:
+        # 依 bit_map 順序把各個 bit plane 交錯排好
+        bits = np.stack([planes[(t['c'], t['b'])] for t in bit_map], axis=1).ravel()
+    
+    # 不滿 8 bit 的尾巴丟掉，再一次打包成 bytes 找結束符號
+    extracted_bytes = np.packbits(bits[:len(bits) // 8 * 8]).tobytes()
+    end = extracted_bytes.find(delimiter_seq)
+    if end < 0:
+        return None
+    
+    try:
+        return extracted_bytes[:end].decode('utf-8')
+    except UnicodeDecodeError:
+        return extracted_bytes[:end].decode('utf-8', errors='ignore')
+
+def decode_image(pixels: np.ndarray, bit_map: list) -> str:
+    """依照 bit_map 解讀圖片訊息 (輸入為 load_rgb_pixels 取得的像素陣列)"""
+    planes = extract_bit_planes(pixels, {(t['c'], t['b']) for t in bit_map})
+    return decode_bit_planes(planes, bit_map)
@@ -0,0 +1,37 @@
+# Gunicorn 生產環境設定 (gunicorn app:app 會自動讀取這個檔案)
+# NumPy / OpenCV / SciPy / numba 在運算時都會釋放 GIL，
+# 用 gthread worker 讓同一個 process 內的多個請求可以真的同時跑在不同核心上
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+workers = max(2, (os.cpu_count() or 2) // 2)
+worker_class = 'gthread'
+threads = 4
+
+# 大圖的 DCT / 自動破解可能要跑一陣子，給寬鬆一點的逾時
+timeout = 60
+
+def post_fork(server, worker):
+    """每個 worker 啟動後限制函式庫內部的執行緒數，避免請求並行時互相搶核心"""
+    import cv2
+    cv2.setNumThreads(1)
+
+    # numba.set_num_threads 只對呼叫它的那條執行緒有效，gthread 的請求執行緒看不到；
+    # 沒有 preload_app，app (和 numba) 是在 post_fork 之後才載入，
+    # 所以在這裡設定環境變數就會成為這個 worker 所有執行緒的預設值
+    # (用 server.cfg.workers 才會反映命令列的 -w 參數)
+    per_worker = max(1, (os.cpu_count() or 1) // server.cfg.workers)
+    os.environ['NUMBA_NUM_THREADS'] = str(per_worker)
+    # gthread 會有多個請求同時呼叫 parallel 的 DCT kernel，
+    # 預設的 workqueue 執行緒層遇到並行呼叫會直接 abort 整個 process；
+    # 指定 threadsafe 只接受 tbb / omp，兩者都沒裝時 worker 啟動就會失敗，而不是執行中才崩潰
+    os.environ['NUMBA_THREADING_LAYER'] = 'threadsafe'
+
+    # numba 的平行執行緒層要在 worker 的主執行緒啟動；
+    # 如果第一次是在 gthread 的請求執行緒裡啟動，worker 結束時會卡住直到被強制終止
+    try:
+        import numba
+        numba.get_num_threads()
+    except ImportError:
+        pass